@@ -8,23 +8,46 @@ Este cliente se conecta a un servidor WebSocket de chat seguro. Características
   en demo) certificados sin verificación estricta.
 - No permite escribir mensajes hasta recibir la clave simétrica del servidor.
 - Cifra los mensajes salientes con Fernet y descifra los entrantes.
+- Los mensajes de chat viajan en frames binarios compactos
+  ([tipo:1][user_id:2][timestamp:4][token Fernet]); el resto del protocolo es JSON.
 - UX básica en consola con feedback de eventos (unión/salida/errores).
 """
 
 import asyncio
 import websockets
-import json
+import orjson
 import threading
 import base64
+import os
+import struct
+import sys
+import time
 from cryptography.fernet import Fernet
-from datetime import datetime
 import ssl
 
+try:
+    import uvloop  # Loop libuv en C (opcional; no disponible en Windows)
+except ImportError:
+    uvloop = None
+
+# Contexto SSL para WSS, construido una sola vez y reutilizado en cada conexión.
+# En demo, se desactiva verificación estricta para facilitar pruebas con ngrok
+# (NO usar así en producción).
+WSS_SSL_CONTEXT = ssl.create_default_context()
+WSS_SSL_CONTEXT.check_hostname = False
+WSS_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# Framing binario de chat (mismo formato que el servidor)
+CHAT_FRAME = 0x01                   # Tipo de frame para chat_message
+CHAT_FRAME_TAG = bytes([CHAT_FRAME])
+CHAT_HEADER = struct.Struct(">BHI") # Cabecera: tipo + user_id + epoch en seg. (big-endian)
+
 class SecureChatClient:
     """
     Implementa un cliente de chat seguro:
     - Mantiene el websocket, el cifrador y el loop asyncio del hilo principal.
-    - Arranca un hilo de entrada por teclado que envía mensajes al loop.
+    - Lee stdin de forma nativa en el loop (add_reader) cuando es una terminal;
+      si no (pipe, archivo, Windows), arranca un hilo de entrada por teclado.
     - Sin permitir input hasta que llegue la clave del servidor (Event asyncio).
     """
     def __init__(self):
@@ -34,28 +57,40 @@ class SecureChatClient:
         self.running = False           # Bandera de ciclo de vida del cliente
         self.loop = None               # Referencia al loop asyncio principal
         self.key_received = asyncio.Event()  # Sincroniza inicio de input tras recibir clave
+        self.stdin_buffer = b""        # Bytes leídos de stdin aún sin salto de línea
+        self.stdin_reader = False      # True si stdin se lee con add_reader (sin hilo)
+        self.pending_sends = set()     # Tareas de envío en curso (referencias vivas)
+        self.user_names = {}           # Mapa user_id -> nombre (para frames binarios)
 
-    def encrypt_message(self, message: str) -> str:
+    def decrypt_message(self, encrypted_message: bytes) -> str:
         """
-        Cifra un mensaje de texto plano usando Fernet y lo devuelve base64 (str).
-        Si aún no hay cifrador (clave), retorna el texto tal cual (fallback).
-        """
-        if self.cipher:
-            return self.cipher.encrypt(message.encode()).decode()
-        return message
-
-    def decrypt_message(self, encrypted_message: str) -> str:
-        """
-        Descifra un mensaje base64 si hay cifrador; si falla, retorna una marca
-        de error legible para el usuario.
+        Descifra un token Fernet (base64) si hay cifrador; si falla, retorna una
+        marca de error legible para el usuario.
         """
         if self.cipher:
             try:
-                return self.cipher.decrypt(encrypted_message.encode()).decode()
+                return self.cipher.decrypt(encrypted_message).decode()
             except Exception:
                 return "[Mensaje cifrado - error al descifrar]"
         return encrypted_message
 
+    def build_chat_frame(self, message: str) -> bytes:
+        """
+        Cifra un mensaje y lo empaqueta como frame binario de chat, con el token
+        Fernet tal cual; el servidor rellena user_id y timestamp.
+        """
+        return CHAT_HEADER.pack(CHAT_FRAME, 0, 0) + self.cipher.encrypt(message.encode())
+
+    def handle_chat_frame(self, frame: bytes):
+        """
+        Muestra un frame binario de chat: resuelve el user_id a nombre, descifra
+        el token y muestra la hora en que el servidor lo recibió.
+        """
+        _, user_id, timestamp = CHAT_HEADER.unpack_from(frame)
+        content = self.decrypt_message(frame[CHAT_HEADER.size:])
+        time_str = time.strftime("%H:%M:%S", time.localtime(timestamp))
+        print(f"[{time_str}] {self.user_names.get(user_id, '?')}: {content}")
+
     async def connect(self, server_url: str, username: str):
         """
         Establece conexión con el servidor:
@@ -66,15 +101,10 @@ class SecureChatClient:
         self.username = username
         try:
             print(f"Conectando a {server_url}...")
-            ssl_context = None
-            if server_url.startswith("wss://"):
-                # Contexto SSL para WSS. En demo, se desactiva verificación estricta
-                # para facilitar pruebas con ngrok (NO usar así en producción).
-                ssl_context = ssl.create_default_context()
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-
-            # Establecer WebSocket
+            ssl_context = WSS_SSL_CONTEXT if server_url.startswith("wss://") else None
+
+            # Establecer WebSocket. permessage-deflate se ofrece (valor por defecto
+            # de websockets); el servidor decide si se usa (su COMPRESSION).
             self.websocket = await websockets.connect(
                 server_url,
                 ssl=ssl_context,
@@ -83,7 +113,7 @@ class SecureChatClient:
             )
 
             # Registro inicial con el servidor
-            await self.websocket.send(json.dumps({"type": "register", "username": username}))
+            await self.websocket.send(orjson.dumps({"type": "register", "username": username}), text=True)
             self.loop = asyncio.get_running_loop()
             self.running = True
 
@@ -97,12 +127,18 @@ class SecureChatClient:
             await self.key_received.wait()
             print("🔐 Canal seguro establecido. Escribe tu mensaje (o 'exit' para salir).\n")
 
-            # Arranca el hilo de entrada por consola (no bloquea el loop)
-            input_thread = threading.Thread(target=self.input_handler, daemon=True)
-            input_thread.start()
+            if not self.start_stdin_reader():
+                # Alternativa: hilo de entrada por consola (no bloquea el loop)
+                input_thread = threading.Thread(target=self.input_handler, daemon=True)
+                input_thread.start()
 
             # Espera a que el listener termine (por cierre remoto u error)
-            await listener
+            try:
+                await listener
+            finally:
+                if self.stdin_reader:
+                    self.stdin_reader = False
+                    self.loop.remove_reader(sys.stdin.fileno())
 
         except Exception as e:
             print(f"❌ Error de conexión: {e}")
@@ -110,12 +146,16 @@ class SecureChatClient:
 
     async def listen_messages(self):
         """
-        Loop asíncrono que recibe mensajes del servidor, los parsea como JSON
-        y delega el manejo según el tipo ('encryption_key', 'chat_message', etc.).
+        Loop asíncrono que recibe mensajes del servidor. Los frames binarios de
+        chat se muestran directamente; el resto se parsea como JSON y se delega
+        según el tipo ('encryption_key', 'user_list', etc.).
         """
         try:
             async for message in self.websocket:
-                data = json.loads(message)
+                if isinstance(message, bytes) and message[:1] == CHAT_FRAME_TAG:
+                    self.handle_chat_frame(message)
+                    continue
+                data = orjson.loads(message)
                 await self.handle_server_message(data)
         except websockets.exceptions.ConnectionClosed:
             print("\n🔌 Conexión cerrada por el servidor")
@@ -128,7 +168,6 @@ class SecureChatClient:
         """
         Enruta los mensajes recibidos por tipo:
         - encryption_key: configura Fernet y habilita input.
-        - chat_message: descifra contenido y lo imprime formateado.
         - user_joined / user_left: notificaciones de presencia.
         - user_list / error: información auxiliar.
         """
@@ -145,30 +184,20 @@ class SecureChatClient:
                 print("❌ Clave inválida recibida")
             return
 
-        if mtype == "chat_message":
-            # Mensaje normal de chat: descifrar, formatear timestamp y mostrar
-            username = data.get("username", "?")
-            encrypted_content = data.get("content", "")
-            timestamp = data.get("timestamp", "")
-            content = self.decrypt_message(encrypted_content)
-            try:
-                dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-                time_str = dt.strftime("%H:%M:%S")
-            except Exception:
-                time_str = ""
-            print(f"[{time_str}] {username}: {content}")
-            return
-
         if mtype == "user_joined":
+            if "user_id" in data:
+                self.user_names[data["user_id"]] = data.get("username", "?")
             print(f"🟢 {data.get('username','?')} se unió al chat")
             return
 
         if mtype == "user_left":
+            self.user_names.pop(data.get("user_id"), None)
             print(f"🔴 {data.get('username','?')} salió del chat")
             return
 
         if mtype == "user_list":
             users = data.get("users", [])
+            self.user_names = dict(zip(data.get("ids", []), users))
             print(f"👥 Usuarios conectados: {', '.join(users)}")
             return
 
@@ -179,26 +208,99 @@ class SecureChatClient:
         # Tipo de mensaje no reconocido (útil para depurar)
         print(f"ℹ️ Mensaje desconocido: {data}")
 
+    def start_stdin_reader(self) -> bool:
+        """
+        Registra stdin en el loop con add_reader. Solo con una terminal: en modo
+        canónico cada read() entrega una línea, así que input() (usado en los
+        prompts de main) no deja líneas pendientes en el buffer de sys.stdin.
+        Con pipes o archivos esas líneas ya estarían en ese buffer y os.read no
+        las vería. Retorna False si no es posible (no es TTY, Windows, archivo
+        regular sin soporte en el selector) para usar el hilo de entrada.
+        """
+        if not sys.stdin.isatty():
+            return False
+        try:
+            self.loop.add_reader(sys.stdin.fileno(), self.on_stdin_ready)
+        except (NotImplementedError, OSError, ValueError):
+            return False
+        self.stdin_reader = True
+        return True
+
+    def on_stdin_ready(self):
+        """
+        Callback del loop cuando stdin tiene datos. Lee lo disponible, separa
+        líneas completas y programa su envío. 'exit', EOF o un error de lectura
+        cierran el cliente.
+        """
+        try:
+            chunk = os.read(sys.stdin.fileno(), 4096)
+        except OSError as e:
+            # Error persistente (p. ej. EIO tras colgar la TTY): stdin seguiría
+            # "listo" y el callback se dispararía sin fin. Se cierra como en EOF.
+            print(f"Error en input: {e}")
+            self.stop_input()
+            return
+        if not chunk:
+            # Fin de entrada
+            self.stop_input()
+            return
+        *lines, self.stdin_buffer = (self.stdin_buffer + chunk).split(b"\n")
+        for raw in lines:
+            message = raw.decode(errors="replace").rstrip("\r")
+            if message.strip().lower() == "exit":
+                self.stop_input()
+                return
+            task = asyncio.create_task(self.send_line(message))
+            self.pending_sends.add(task)
+            task.add_done_callback(self.pending_sends.discard)
+
+    def stop_input(self):
+        """
+        Deja de leer stdin y cierra la conexión (termina el listener).
+        """
+        self.running = False
+        if self.stdin_reader:
+            self.stdin_reader = False
+            self.loop.remove_reader(sys.stdin.fileno())
+        task = asyncio.create_task(self.disconnect())
+        self.pending_sends.add(task)
+        task.add_done_callback(self.pending_sends.discard)
+
+    async def send_line(self, message: str):
+        """
+        Cifra una línea escrita por el usuario y la envía al servidor.
+        """
+        if not self.cipher:
+            # Todavía no se recibió la clave del servidor
+            print("Aún no se ha establecido la clave. Espera un momento…")
+            return
+        if message.strip() and self.websocket:
+            try:
+                await self.websocket.send(self.build_chat_frame(message))
+            except Exception as e:
+                print(f"Error enviando mensaje: {e}")
+
     def input_handler(self):
         """
-        Hilo dedicado a leer desde stdin y enviar por WebSocket.
+        Alternativa cuando stdin no se puede leer con add_reader (pipe, archivo,
+        Windows): hilo dedicado a leer desde stdin y enviar por WebSocket.
         Usa run_coroutine_threadsafe para postear en el loop asyncio principal.
-        Interpreta 'exit' para cerrar el cliente limpamente.
+        Interpreta 'exit' (o EOF) para cerrar el cliente limpiamente.
         """
         while self.running:
             try:
                 message = input()
                 if message.strip().lower() == "exit":
                     self.running = False
+                    asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop)
                     break
                 if not self.cipher:
                     # Todavía no se recibió la clave del servidor
                     print("Aún no se ha establecido la clave. Espera un momento…")
                     continue
                 if message.strip() and self.websocket and self.loop:
-                    encrypted_content = self.encrypt_message(message)
                     fut = asyncio.run_coroutine_threadsafe(
-                        self.websocket.send(json.dumps({"type": "chat_message", "content": encrypted_content})),
+                        self.websocket.send(self.build_chat_frame(message)),
                         self.loop
                     )
                     # Espera corta para propagar errores del envío
@@ -209,6 +311,7 @@ class SecureChatClient:
             except (EOFError, KeyboardInterrupt):
                 # Fin de entrada o Ctrl+C
                 self.running = False
+                asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop)
                 break
             except Exception as e:
                 # Cualquier otro error de input se reporta sin tumbar el cliente
@@ -262,6 +365,9 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n👋 ¡Hasta luego!")